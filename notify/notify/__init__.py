@@ -33,9 +33,11 @@ db = MongoEngine()
 
 def make_app():
     import factory
+    import shards
 
     application = factory.create_app(app_name, cwd, settings_override=config)
     db.init_app(application)
+    shards.init_app(application)
     return application
 
 
@@ -1,13 +1,29 @@
+from datetime import datetime
+
 from bson import json_util
-from flask import request, Blueprint
+from bson.objectid import ObjectId
+from flask import abort, request, Blueprint
 from flask.ext.mongoengine.wtf import model_form
 from flask.views import MethodView
+from mongoengine import NotUniqueError
 import simplejson as json
 
 from notify import utils
 from notify import auth
 from notify import config
-from notify.models import Notification, User
+from notify import reads
+from notify import shards
+from notify.models import Broadcast, Notification, Segment, User
+
+
+def _invalid_ids(*fields):
+    errors = {}
+    for field in fields:
+        invalid = [value for value in request.form.getlist(field)
+                   if not ObjectId.is_valid(value)]
+        if invalid:
+            errors[field] = ['Invalid id: %s' % value for value in invalid]
+    return errors
 
 
 class NotificationView(MethodView):
@@ -17,44 +33,81 @@ class NotificationView(MethodView):
     ]
 
     @auth.user()
-    def get(self, id_):
-        if id_ is None:
-            self._index()
+    def get(self, notification_id):
+        user_pk = request.headers.get('x-balanced-user')
+        if not ObjectId.is_valid(user_pk):
+            # no user can be stored under an id that is not an ObjectId
+            if notification_id is None:
+                return json.dumps({'data': []}), 200
+            abort(404)
+        if notification_id is None:
+            return self._index(user_pk)
         else:
-            self._show(id_)
+            return self._show(user_pk, notification_id)
 
-    def _index(self):
-        user_pk = request.headers.get('x-balanced-user')
-        user = User.objects.get(user_pk)
+    def _index(self, user_pk):
+        read_preference = reads.preference('notifications', user_pk)
         data = []
-        for notification in user.notifications:
+        for notification in Notification.due_for(
+                user_pk, read_preference=read_preference):
             data.append({
                 'message': notification.message,
-                'id': notification.id,
+                'id': '%s' % notification.id,
             })
-        return json.dumps(data, default=json_util.default), 200
+        return json.dumps({'data': data}, default=json_util.default), 200
 
-    def _show(self, id_):
-        notification = Notification.objects.get(id_)
-        data = [dict(message=notification.message, id=notification.id)]
-        return json.dumps(data, default=json_util.default), 200
+    def _show(self, user_pk, id_):
+        read_preference = reads.preference('notifications', user_pk)
+        notification = Notification.due_for(
+            user_pk, read_preference=read_preference).get_or_404(pk=id_)
+        data = [dict(message=notification.message, id='%s' % notification.id)]
+        return json.dumps({'data': data}, default=json_util.default), 200
 
+    @auth.admin()
     def post(self):
         form_cls = model_form(Notification)
-        notification = Notification()
         form = form_cls(request.form, csrf_enabled=False)
         if not form.validate():
             return json.dumps(form.errors, default=json_util.default), 400
 
-        form.populate_obj(notification)
-        notification.save()
-        data = [dict(message=notification.message, id='%s' % notification.pk)]
+        user = form.user_id.data
+        deliver_at = form.deliver_at.data
+        segment = None
+        if request.form.get('segment'):
+            if user is not None:
+                errors = {'segment': ['Cannot target a user and a segment']}
+                return json.dumps(errors, default=json_util.default), 400
+            segment = Segment.objects(name=request.form['segment']).first()
+            if segment is None:
+                errors = {'segment': ['Unknown segment']}
+                return json.dumps(errors, default=json_util.default), 400
+
+        if user is None:
+            # the scheduler writes broadcasts, to a segment or to everyone,
+            # in batches within its write budget
+            broadcast = Broadcast(
+                message=form.message.data,
+                deliver_at=deliver_at or datetime.utcnow(),
+                segment=segment).save()
+            data = [dict(message=broadcast.message, id='%s' % broadcast.pk)]
+            return json.dumps({'data': data}, default=json_util.default), 202
+
+        ids = Notification.create_notifications(
+            form.message.data, user.pk, deliver_at)
+        data = [dict(message=form.message.data, id='%s' % id_) for id_ in ids]
         return json.dumps({'data': data}, default=json_util.default), 201
 
     @auth.user()
     def delete(self, notification_id):
-        notification = Notification.objects.get_or_404(pk=notification_id)
-        notification.delete()
+        user_pk = request.headers.get('x-balanced-user')
+        if not ObjectId.is_valid(user_pk):
+            abort(404)
+        notifications = Notification.for_user(user_pk)
+        notification = notifications.get_or_404(pk=notification_id)
+        # delete through the shard-bound queryset, Document.delete() would
+        # go to the default connection
+        notifications.filter(pk=notification.pk).delete()
+        reads.pin_primary(user_pk)
         return '', 204
 
 
@@ -77,25 +130,26 @@ class UsersView(MethodView):
         auth.admin()
     ]
 
-    def get(self, id_=None):
-        if id_ is None:
-            self._index()
+    def get(self, user_id=None):
+        users = shards.queryset(User, shards.DEFAULT_CONNECTION_NAME,
+                                reads.preference('users'))
+        if user_id is None:
+            return self._index(users)
         else:
-            self._show(id_)
+            return self._show(users, user_id)
 
-    def _index(self):
+    def _index(self, users):
         data = []
-        for user in User.objects.all():
+        for user in users.only('id', 'email'):
             data.append({
-                'id': user.id,
+                'id': '%s' % user.id,
                 'email': user.email,
             })
         return json.dumps({'data': data}, default=json_util.default), 200
 
-
-    def _show(self, id_):
-        user = User.objects.get(pk=id_)
-        data = [dict(id=user.id, email=user.email)]
+    def _show(self, users, id_):
+        user = users.get_or_404(pk=id_)
+        data = [dict(id='%s' % user.id, email=user.email)]
         return json.dumps({'data': data}, default=json_util.default), 200
 
 
@@ -110,6 +164,78 @@ utils.register_api(
 )
 
 
+class SegmentsView(MethodView):
+
+    decorators = [
+        utils.crossdomain(origin=config.get('CORS_DOMAIN')),
+        auth.admin()
+    ]
+
+    def get(self, segment_name=None):
+        if segment_name is None:
+            return self._index()
+        else:
+            return self._show(segment_name)
+
+    def _index(self):
+        data = []
+        for segment in Segment.objects.only('name', 'size'):
+            data.append({
+                'name': segment.name,
+                'size': segment.size,
+            })
+        return json.dumps({'data': data}, default=json_util.default), 200
+
+    def _show(self, name):
+        segment = Segment.objects.get_or_404(name=name)
+        data = [dict(name=segment.name, size=segment.size)]
+        return json.dumps({'data': data}, default=json_util.default), 200
+
+    def post(self):
+        form_cls = model_form(Segment, only=['name'])
+        form = form_cls(request.form, csrf_enabled=False)
+        if not form.validate():
+            return json.dumps(form.errors, default=json_util.default), 400
+        errors = _invalid_ids('user_id')
+        if errors:
+            return json.dumps(errors, default=json_util.default), 400
+
+        try:
+            segment = Segment(name=form.name.data).save()
+        except NotUniqueError:
+            errors = {'name': ['A segment with this name already exists']}
+            return json.dumps(errors, default=json_util.default), 400
+        segment.add(request.form.getlist('user_id'))
+        data = [dict(name=segment.name, size=segment.size)]
+        return json.dumps({'data': data}, default=json_util.default), 201
+
+    def put(self, segment_name):
+        segment = Segment.objects.get_or_404(name=segment_name)
+        errors = _invalid_ids('add', 'remove')
+        if errors:
+            return json.dumps(errors, default=json_util.default), 400
+
+        segment.add(request.form.getlist('add'))
+        segment.remove(request.form.getlist('remove'))
+        data = [dict(name=segment.name, size=segment.size)]
+        return json.dumps({'data': data}, default=json_util.default), 200
+
+    def delete(self, segment_name):
+        Segment.objects.get_or_404(name=segment_name).delete()
+        return '', 204
+
+
+segments = Blueprint('segments', __name__, url_prefix='/segments')
+utils.register_api(
+    view=SegmentsView,
+    endpoint='segments',
+    url='',
+    app=segments,
+    pk='segment_name',
+    pk_type='string'
+)
+
+
 #@app.route('/notifications', methods=['GET'])
 #@crossdomain(origin=app.config.get('CORS_DOMAIN'))
 #@auth.user()
@@ -37,7 +37,8 @@ def create_app(package_name, package_path, settings_override=None):
 
     app.config.from_object('notify.settings')
     app.config.from_pyfile('settings.cfg', silent=True)
-    app.config.from_object(settings_override)
+    # from_object() only picks up attributes, so it would skip a dict
+    app.config.update(settings_override or {})
 
     register_blueprints(app, package_name, [package_path])
     return app
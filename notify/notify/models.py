@@ -1,8 +1,38 @@
+import hashlib
 from datetime import datetime
+from itertools import islice
 
 from bson.objectid import ObjectId
+from mongoengine.queryset import CASCADE, Q
+from pymongo.errors import BulkWriteError
 
-from notify import db
+from notify import config, db, shards
+
+
+DUPLICATE_KEY = 11000
+
+
+def _insert_new(collection, docs):
+    """Inserts ``docs``, skipping any whose unique keys already exist, and
+    returns how many were inserted.
+
+    """
+    try:
+        return len(collection.insert_many(docs, ordered=False).inserted_ids)
+    except BulkWriteError as ex:
+        if any(error['code'] != DUPLICATE_KEY
+               for error in ex.details['writeErrors']):
+            raise
+        return ex.details['nInserted']
+
+
+def _chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 class User(db.Document):
@@ -16,6 +46,259 @@ class Notification(db.Document):
     message = db.StringField()
     user_id = db.ReferenceField(User)
     created_at = db.DateTimeField()
+    deliver_at = db.DateTimeField()
+
+    meta = {
+        'indexes': [('user_id', 'deliver_at')],
+    }
+
+    @classmethod
+    def for_user(cls, user_id, read_preference=None):
+        """Returns a queryset over ``user_id``'s notifications, bound to the
+        shard that holds them.
+
+        :param user_id: the user's id
+        :param read_preference: a pymongo read preference for reads that
+            can tolerate lag, or ``None`` to use the primary
+
+        """
+        alias = shards.router().shard_for(user_id)
+        return shards.queryset(cls, alias, read_preference).filter(
+            user_id=user_id)
+
+    @classmethod
+    def due_for(cls, user_id, now=None, read_preference=None):
+        """Like :meth:`for_user` but hides notifications whose
+        ``deliver_at`` has not been reached yet.
+
+        :param user_id: the user's id
+        :param now: the time to compare ``deliver_at`` against
+        :param read_preference: see :meth:`for_user`
+
+        """
+        now = now or datetime.utcnow()
+        # $not also matches notifications written before deliver_at existed,
+        # and unlike an $or with $exists it stays within the index bounds
+        return cls.for_user(user_id, read_preference).filter(
+            deliver_at__not__gt=now)
+
+    @classmethod
+    def deliver(cls, message, user_ids, deliver_at=None, broadcast=None):
+        """Writes ``message`` for each of ``user_ids``, in parallel across
+        shards, and returns the new notification ids.
+
+        :param message: the notification text
+        :param user_ids: the recipients
+        :param deliver_at: when the notifications become visible, defaults
+            to now
+        :param broadcast: the :class:`Broadcast` being released, if any.
+            Its notifications get ids derived from the broadcast and user,
+            so writing the same batch again leaves no duplicates.
+
+        """
+        created_at = datetime.utcnow()
+        deliver_at = deliver_at or created_at
+
+        def insert(alias, ids):
+            docs = []
+            for id_ in ids:
+                notification = cls(
+                    message=message, user_id=id_, created_at=created_at,
+                    deliver_at=deliver_at)
+                if broadcast is None:
+                    notification.id = ObjectId()
+                else:
+                    notification.id = broadcast.notification_id(id_)
+                docs.append(notification.to_mongo())
+            _insert_new(shards.collection(cls, alias), docs)
+            return [doc['_id'] for doc in docs]
+
+        results = shards.fan_out(insert, shards.group_by_shard(user_ids))
+        return [id_ for ids in results.itervalues() for id_ in ids]
+
+    @classmethod
+    def create_notifications(cls, message, user_id, deliver_at=None):
+        """Writes ``message`` for a single user and returns the new
+        notification ids. Broadcasts go through :class:`Broadcast` and the
+        scheduler instead.
+
+        :param message: the notification text
+        :param user_id: the recipient
+        :param deliver_at: when the notification becomes visible, defaults
+            to now
+
+        """
+        return cls.deliver(message, [user_id], deliver_at)
+
+
+class Segment(db.Document):
+    """A named audience. Its members are kept as one
+    :class:`SegmentMember` per user so they can be added, removed and
+    streamed without loading the whole list.
+
+    """
+
+    name = db.StringField(required=True, unique=True)
+    size = db.IntField(default=0)
+    created_at = db.DateTimeField(default=datetime.utcnow)
+
+    def members(self):
+        return SegmentMember.objects.filter(segment=self)
+
+    def add(self, user_ids):
+        """Adds ``user_ids`` to the segment, ignoring existing members and
+        ids with no user behind them, and returns how many were new.
+
+        :param user_ids: the ids of the users to add
+
+        """
+        collection = SegmentMember._get_collection()
+        added = 0
+        for batch in _chunks(user_ids, config['SEGMENT_BATCH_SIZE']):
+            batch = [ObjectId(user_id) for user_id in batch]
+            docs = [{'segment': self.pk, 'user_id': user_id}
+                    for user_id in User.objects(id__in=batch).scalar('id')]
+            if not docs:
+                continue
+            # existing members are rejected by the unique index
+            added += _insert_new(collection, docs)
+        if added:
+            self.update(inc__size=added)
+            self.size += added
+        return added
+
+    def remove(self, user_ids):
+        """Removes ``user_ids`` from the segment and returns how many were
+        members.
+
+        :param user_ids: the ids of the users to remove
+
+        """
+        removed = 0
+        for batch in _chunks(user_ids, config['SEGMENT_BATCH_SIZE']):
+            removed += self.members().filter(
+                user_id__in=[ObjectId(user_id) for user_id in batch]).delete()
+        if removed:
+            self.update(dec__size=removed)
+            self.size -= removed
+        return removed
+
+
+class SegmentMember(db.Document):
+
+    segment = db.ReferenceField(
+        Segment, required=True, reverse_delete_rule=CASCADE)
+    user_id = db.ObjectIdField(required=True)
+
+    meta = {
+        'indexes': [
+            {'fields': ('segment', 'user_id'), 'unique': True},
+        ],
+    }
+
+
+class Broadcast(db.Document):
+    """A broadcast staged for the scheduler, which writes its notifications
+    in throttled batches instead of all at once. ``last_user_id`` records
+    how far the release has got so an interrupted one can resume.
+
+    """
+
+    PENDING = 'pending'
+    RELEASING = 'releasing'
+    RELEASED = 'released'
+
+    message = db.StringField(required=True)
+    deliver_at = db.DateTimeField(required=True)
+    created_at = db.DateTimeField(default=datetime.utcnow)
+    state = db.StringField(
+        default=PENDING, choices=(PENDING, RELEASING, RELEASED))
+    lease_owner = db.StringField()
+    leased_until = db.DateTimeField()
+    # deleting a segment cancels the broadcasts aimed at it
+    segment = db.ReferenceField(Segment, reverse_delete_rule=CASCADE)
+    last_user_id = db.ObjectIdField()
+    released = db.IntField(default=0)
+
+    meta = {
+        'indexes': [('state', 'deliver_at')],
+    }
+
+    @classmethod
+    def due(cls, until):
+        """Returns the unfinished broadcasts due by ``until``, oldest first.
+
+        :param until: latest ``deliver_at`` to include
+
+        """
+        return cls.objects.filter(
+            state__in=[cls.PENDING, cls.RELEASING],
+            deliver_at__lte=until).order_by('deliver_at')
+
+    def claim(self, owner, lease, **updates):
+        """Takes or extends ``owner``'s lease on the broadcast, unless
+        another scheduler holds one that has not expired, and applies
+        ``updates`` in the same write. Returns the updated broadcast, or
+        ``None`` if the lease is held elsewhere or the broadcast is done.
+
+        :param owner: identifies the scheduler process
+        :param lease: how long the lease lasts, as a timedelta
+        :param updates: further mongoengine update operators to apply
+
+        """
+        now = datetime.utcnow()
+        return Broadcast.objects(
+            Q(lease_owner=owner) | Q(leased_until__not__gt=now),
+            pk=self.pk,
+            state__in=[self.PENDING, self.RELEASING],
+        ).modify(new=True, set__state=self.RELEASING, set__lease_owner=owner,
+                 set__leased_until=now + lease, **updates)
+
+    def finish(self, owner):
+        Broadcast.objects(pk=self.pk, lease_owner=owner).update_one(
+            set__state=self.RELEASED, unset__leased_until=True)
+
+    def notification_id(self, user_id):
+        """Returns the id of the notification this broadcast writes for
+        ``user_id``, which is the same every time it is asked for.
+
+        :param user_id: the recipient's id
+
+        """
+        digest = hashlib.md5(
+            self.pk.binary + ObjectId(user_id).binary).digest()
+        return ObjectId(digest[:12])
+
+    def next_recipients(self, batch_size):
+        """Returns the ids of the next ``batch_size`` users to release to,
+        taken from the segment if there is one or from every user if not.
+
+        :param batch_size: maximum number of ids to return
+
+        """
+        if self.segment:
+            queryset, field = self.segment.members(), 'user_id'
+        else:
+            queryset, field = User.objects, 'id'
+        # a range query past the last batch, so each one costs the same
+        if self.last_user_id is not None:
+            queryset = queryset.filter(
+                **{'%s__gt' % field: self.last_user_id})
+        return list(queryset.order_by(field).limit(batch_size).scalar(field))
+
+
+class ReadPin(db.Document):
+    """Keeps a user's reads on the primary until ``until`` so they see their
+    own recent writes. Expired pins are removed by a TTL index.
+
+    """
+
+    user_id = db.ObjectIdField(primary_key=True)
+    until = db.DateTimeField(required=True)
+
+    meta = {
+        'indexes': [{'fields': ['until'], 'expireAfterSeconds': 0}],
+    }
 
 
 class _Notification(object):
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+from pymongo import read_preferences
+
+from notify import config
+from notify.models import ReadPin
+
+
+_MODES = {
+    'primaryPreferred': read_preferences.PrimaryPreferred,
+    'secondary': read_preferences.Secondary,
+    'secondaryPreferred': read_preferences.SecondaryPreferred,
+    'nearest': read_preferences.Nearest,
+}
+
+
+def pin_primary(user_id):
+    """Sends ``user_id``'s reads to the primary for ``PRIMARY_PIN_SECONDS``
+    so they see the write the user just made. The pin is stored in Mongo, so
+    it holds on every server process and whatever client the user reads
+    from.
+
+    :param user_id: the id of the user who wrote
+
+    """
+    if not config['PRIMARY_PIN_SECONDS']:
+        return
+    until = datetime.utcnow() + timedelta(
+        seconds=config['PRIMARY_PIN_SECONDS'])
+    ReadPin.objects(user_id=user_id).update_one(
+        set__until=until, upsert=True)
+
+
+def pinned(user_id):
+    if not config['PRIMARY_PIN_SECONDS']:
+        return False
+    # a single _id lookup on the primary, where the pin was written; expired
+    # pins linger until the TTL monitor removes them, so check until here
+    until = ReadPin.objects(user_id=user_id).scalar('until').first()
+    return until is not None and until > datetime.utcnow()
+
+
+def preference(endpoint, user_id=None):
+    """Returns the read preference configured for ``endpoint`` in
+    ``READ_PREFERENCES``, or ``None`` when its reads should go to the
+    primary.
+
+    :param endpoint: the endpoint name, e.g. ``'notifications'``
+    :param user_id: the user reading, if any, whose recent writes must be
+        visible
+
+    """
+    mode, max_staleness = config['READ_PREFERENCES'].get(
+        endpoint, ('primary', None))
+    if mode == 'primary' or (user_id is not None and pinned(user_id)):
+        return None
+    return _MODES[mode](max_staleness=max_staleness or -1)
@@ -0,0 +1,7 @@
+from notify import make_app, shards
+from notify.models import Notification
+
+
+if __name__ == '__main__':
+    make_app()
+    print shards.rebalance(Notification)
@@ -0,0 +1,110 @@
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+from notify import config
+from notify.models import Broadcast, Notification
+
+
+_owner = '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class TokenBucket(object):
+    """Limits writes to ``rate`` per second on average, allowing bursts of
+    up to ``capacity``.
+
+    :param rate: tokens added per second
+    :param capacity: most tokens that can be saved up, defaults to ``rate``
+    :param clock: returns the current time in seconds
+    :param sleep: blocks for the given number of seconds
+
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time,
+                 sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = capacity or self.rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.stamp = clock()
+
+    def consume(self, tokens):
+        """Takes ``tokens`` from the bucket, blocking until the debt they
+        leave has been paid back.
+
+        :param tokens: number of writes about to be made
+
+        """
+        now = self.clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= tokens
+        if self.tokens < 0:
+            self.sleep(-self.tokens / self.rate)
+
+
+def release(broadcast, bucket, batch_size):
+    """Writes the remaining notifications for ``broadcast`` one batch of
+    users at a time and returns how many were written. The broadcast is
+    leased to this process for ``SCHEDULER_LEASE_TIME`` seconds, renewed
+    with every batch, so other schedulers leave it alone. A batch repeated
+    after a crash or a lost lease writes no duplicates, see
+    :meth:`Broadcast.notification_id`.
+
+    :param broadcast: the :class:`Broadcast` to release
+    :param bucket: the :class:`TokenBucket` writes are charged to
+    :param batch_size: number of users written per batch
+
+    """
+    lease = timedelta(seconds=config['SCHEDULER_LEASE_TIME'])
+    written = 0
+    broadcast = broadcast.claim(_owner, lease)
+    while broadcast is not None:
+        user_ids = broadcast.next_recipients(batch_size)
+        if not user_ids:
+            broadcast.finish(_owner)
+            break
+        bucket.consume(len(user_ids))
+        Notification.deliver(broadcast.message, user_ids,
+                             deliver_at=broadcast.deliver_at,
+                             broadcast=broadcast)
+        written += len(user_ids)
+        # None here means another scheduler has taken the lease over
+        broadcast = broadcast.claim(
+            _owner, lease, set__last_user_id=user_ids[-1],
+            inc__released=len(user_ids))
+    return written
+
+
+def release_due(now=None, bucket=None):
+    """Releases every broadcast whose ``deliver_at`` falls within
+    ``SCHEDULER_LEAD_TIME`` of ``now``. Notifications written early stay
+    hidden from readers until they are due.
+
+    :param now: the current time, defaults to now
+    :param bucket: the :class:`TokenBucket` writes are charged to, defaults
+        to one refilling at ``SCHEDULER_WRITE_RATE``
+
+    """
+    now = now or datetime.utcnow()
+    bucket = bucket or TokenBucket(config['SCHEDULER_WRITE_RATE'])
+    until = now + timedelta(seconds=config['SCHEDULER_LEAD_TIME'])
+    return [release(broadcast, bucket, config['SCHEDULER_BATCH_SIZE'])
+            for broadcast in Broadcast.due(until)]
+
+
+def run():
+    bucket = TokenBucket(config['SCHEDULER_WRITE_RATE'])
+    while True:
+        release_due(bucket=bucket)
+        time.sleep(config['SCHEDULER_POLL_INTERVAL'])
+
+
+if __name__ == '__main__':
+    import notify
+
+    notify.make_app()
+    run()
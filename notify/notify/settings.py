@@ -30,4 +30,58 @@ else:
 MONGODB_SETTINGS = {
     'DB': 'notify',
     'host': 'localhost'
-}
\ No newline at end of file
+}
+
+
+# Notifications are partitioned by user id across these connections. An
+# entry without an alias reuses the default MONGODB_SETTINGS connection;
+# any other entry takes the same keys as MONGODB_SETTINGS (DB, host, port,
+# username, password, replicaset, or a mongodb:// URI as host). Each shard
+# also gets a read connection with the same settings, to read_host if given,
+# for lag-tolerant reads; give a replicaset so they can reach secondaries.
+SHARDS = [
+    {},
+]
+
+SHARD_ROUTER = 'notify.shards.HashShardRouter'
+
+# maximum number of shards a broadcast writes to concurrently
+SHARD_FANOUT_WORKERS = 4
+
+# scheduled broadcasts are released this many seconds before their
+# deliver_at and stay hidden from readers until then
+SCHEDULER_LEAD_TIME = 3600
+
+# number of users a scheduled broadcast is written to per batch
+SCHEDULER_BATCH_SIZE = 500
+
+# notification writes per second the scheduler may issue. Every broadcast,
+# to a segment or to everyone, is written at this rate, so one sent now
+# starts reaching users after up to SCHEDULER_POLL_INTERVAL seconds and a
+# 100,000-user segment takes about 50 seconds to finish, not a few. Raise
+# both only as far as the primary can absorb the extra writes.
+SCHEDULER_WRITE_RATE = 2000
+
+# seconds the scheduler waits between looking for due broadcasts
+SCHEDULER_POLL_INTERVAL = 10
+
+# seconds a scheduler keeps its claim on a broadcast between batches before
+# another scheduler may take it over
+SCHEDULER_LEASE_TIME = 300
+
+# read preference mode and max staleness for each read-only endpoint;
+# endpoints not listed read from the primary. A max staleness (in seconds,
+# at least 90) needs MongoDB 3.4 or later, so leave it as None on older
+# servers such as the one the cookbook provisions.
+READ_PREFERENCES = {
+    'notifications': ('secondaryPreferred', None),
+    'users': ('secondaryPreferred', None),
+}
+
+# seconds a user's reads stay on the primary after they write. Every read of
+# an endpoint above made for a user first checks for a pin, which costs one
+# _id lookup on the primary; 0 turns the pin, and that lookup, off.
+PRIMARY_PIN_SECONDS = 5
+
+# number of segment members added or removed per write
+SEGMENT_BATCH_SIZE = 1000
@@ -0,0 +1,256 @@
+import hashlib
+import importlib
+from multiprocessing.pool import ThreadPool
+
+from bson.objectid import ObjectId
+from mongoengine.connection import DEFAULT_CONNECTION_NAME, get_db, \
+    register_connection
+from mongoengine.queryset import QuerySet
+from pymongo import ReplaceOne
+
+
+_router = None
+_collections = {}
+_pool = None
+
+
+class ShardRouter(object):
+    """Maps a user id onto the connection alias of the shard that owns it.
+
+    :param aliases: ordered list of connection aliases, one per shard
+
+    """
+
+    def __init__(self, aliases):
+        self.aliases = list(aliases)
+
+    def shard_for(self, user_id):
+        raise NotImplementedError
+
+
+class HashShardRouter(ShardRouter):
+    """Routes users by a jump consistent hash of their id, so every process
+    agrees on placement without a lookup table. Appending a shard to the end
+    of ``SHARDS`` moves only the users that now belong on it, about 1/N of
+    them; shards must not be reordered or removed from the middle.
+
+    Ids are hashed in their binary form, so an ObjectId and its hex string
+    in either case all land on the same shard.
+
+    """
+
+    def shard_for(self, user_id):
+        if len(self.aliases) == 1:
+            return self.aliases[0]
+        key = int(hashlib.md5(ObjectId(user_id).binary).hexdigest()[:16], 16)
+        return self.aliases[_jump_hash(key, len(self.aliases))]
+
+
+def _jump_hash(key, buckets):
+    # Lamping & Veach, "A Fast, Minimal Memory, Consistent Hash Algorithm"
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def _import_string(path):
+    module_name, _, attr = path.rpartition('.')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def _connection_settings(shard):
+    # read the way flask-mongoengine reads MONGODB_SETTINGS: any key case,
+    # with everything besides DB passed through to the client
+    settings = dict((key.lower(), value) for key, value in shard.items()
+                    if value is not None)
+    settings.pop('alias', None)
+    settings.pop('read_host', None)
+    # without DB, register_connection takes the name from a mongodb:// host
+    if 'db' in settings:
+        settings['name'] = settings.pop('db')
+    if 'replicaset' in settings:
+        settings['replicaSet'] = settings.pop('replicaset')
+    return settings
+
+
+def init_app(app):
+    """Registers a write and a read connection for every shard listed in
+    ``SHARDS`` and builds the router named by ``SHARD_ROUTER``.
+
+    :param app: the Flask application
+
+    """
+    global _pool, _router
+
+    _collections.clear()
+    if _pool is None:
+        _pool = ThreadPool(app.config['SHARD_FANOUT_WORKERS'])
+    aliases = []
+    for shard in app.config['SHARDS']:
+        alias = shard.get('alias', DEFAULT_CONNECTION_NAME)
+        if alias == DEFAULT_CONNECTION_NAME:
+            # the default connection is set up from MONGODB_SETTINGS
+            shard = dict(app.config['MONGODB_SETTINGS'], **shard)
+        else:
+            register_connection(alias, **_connection_settings(shard))
+
+        read_settings = _connection_settings(shard)
+        if shard.get('read_host'):
+            read_settings['host'] = shard['read_host']
+        register_connection(read_alias(alias), **read_settings)
+        aliases.append(alias)
+
+    router_cls = _import_string(app.config['SHARD_ROUTER'])
+    _router = router_cls(aliases)
+    return _router
+
+
+def router():
+    if _router is None:
+        raise RuntimeError('shards.init_app() has not been called')
+    return _router
+
+
+def read_alias(alias):
+    """Returns the alias of the connection used for lag-tolerant reads from
+    shard ``alias``.
+
+    :param alias: the shard's connection alias
+
+    """
+    return '%s-read' % alias
+
+
+def collection(document_cls, alias):
+    """Returns the pymongo collection holding ``document_cls`` on connection
+    ``alias``, creating its indexes the first time it is asked for.
+
+    Shards are addressed through these collections rather than
+    ``QuerySet.using()``, which swaps the class-wide ``db_alias`` while it
+    runs and so is not safe to call from several threads at once.
+
+    :param document_cls: the Document class
+    :param alias: the connection alias
+
+    """
+    key = (document_cls, alias)
+    if key not in _collections:
+        shard_collection = get_db(alias)[document_cls._get_collection_name()]
+        for spec in document_cls._meta['index_specs']:
+            spec = spec.copy()
+            fields = spec.pop('fields')
+            spec.pop('cls', None)
+            shard_collection.create_index(fields, **spec)
+        _collections[key] = shard_collection
+    return _collections[key]
+
+
+def queryset(document_cls, alias, read_preference=None):
+    """Returns a queryset over ``document_cls`` on shard ``alias``. Reads
+    that can tolerate lag pass a ``read_preference`` and go through the
+    shard's read connection.
+
+    :param document_cls: the Document class
+    :param alias: the shard's connection alias
+    :param read_preference: a pymongo read preference, or ``None`` to read
+        from the primary
+
+    """
+    queryset_cls = document_cls._meta.get('queryset_class', QuerySet)
+    if read_preference is None:
+        return queryset_cls(document_cls, collection(document_cls, alias))
+
+    read_collection = get_db(read_alias(alias))[
+        document_cls._get_collection_name()].with_options(
+            read_preference=read_preference)
+    return queryset_cls(document_cls, read_collection).read_preference(
+        read_preference)
+
+
+def group_by_shard(user_ids, shard_router=None):
+    """Buckets ``user_ids`` into a dict of shard alias to list of ids.
+
+    :param user_ids: iterable of user ids
+    :param shard_router: router to use, defaults to the configured one
+
+    """
+    shard_router = shard_router or router()
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(shard_router.shard_for(user_id), []).append(user_id)
+    return groups
+
+
+def fan_out(func, groups):
+    """Calls ``func(alias, items)`` for every shard in ``groups`` in
+    parallel, on a pool of ``SHARD_FANOUT_WORKERS`` threads shared by every
+    call, and returns a dict of shard alias to result.
+
+    :param func: callable taking a shard alias and that shard's items
+    :param groups: dict of shard alias to items, see :func:`group_by_shard`
+
+    """
+    if len(groups) <= 1:
+        return dict((alias, func(alias, items))
+                    for alias, items in groups.iteritems())
+
+    if _pool is None:
+        raise RuntimeError('shards.init_app() has not been called')
+    return dict(_pool.map(lambda pair: (pair[0], func(*pair)),
+                          groups.items()))
+
+
+def _shard_key(doc, key_field):
+    value = doc[key_field]
+    # ReferenceFields may be stored either as a bare id or as a DBRef
+    return getattr(value, 'id', value)
+
+
+def rebalance(document_cls, shard_router=None, sources=None,
+              key_field='user_id', batch_size=500):
+    """Moves every document of ``document_cls`` that is not on the shard its
+    ``key_field`` routes to. Documents are copied to their new shard before
+    being removed from the old one, so an interrupted run can simply be
+    restarted.
+
+    :param document_cls: the sharded Document class
+    :param shard_router: router describing the target layout, defaults to
+        the configured one
+    :param sources: aliases to drain, defaults to the router's aliases. Pass
+        the old layout here when retiring a shard.
+    :param key_field: the field documents are routed by
+    :param batch_size: number of documents copied and removed per round
+
+    """
+    shard_router = shard_router or router()
+    collection_name = document_cls._get_collection_name()
+    moved = {}
+
+    def move(source_collection, batch):
+        for target, docs in batch.iteritems():
+            get_db(target)[collection_name].bulk_write(
+                [ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+                 for doc in docs], ordered=False)
+            moved[target] = moved.get(target, 0) + len(docs)
+        source_collection.delete_many({'_id': {'$in': [
+            doc['_id'] for docs in batch.itervalues() for doc in docs]}})
+
+    for source in sources or shard_router.aliases:
+        source_collection = get_db(source)[collection_name]
+        batch, pending = {}, 0
+        for doc in source_collection.find():
+            target = shard_router.shard_for(_shard_key(doc, key_field))
+            if target == source:
+                continue
+            batch.setdefault(target, []).append(doc)
+            pending += 1
+            if pending >= batch_size:
+                move(source_collection, batch)
+                batch, pending = {}, 0
+        if batch:
+            move(source_collection, batch)
+
+    return moved